@@ -5,17 +5,485 @@ Module 1: Basic MCP Server - Starter Code
 
 #this is the comment to check changes in git repository
 
+import asyncio
+import collections
+import functools
 import json
-import subprocess
+import os
+import re
+import signal
+import stat
+import time
+import weakref
 from pathlib import Path
 
 from mcp.server.fastmcp import FastMCP
 
+try:
+    import pygit2
+except ImportError:
+    # pygit2 is optional; without it we fall back to the git CLI
+    pygit2 = None
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; without it responses are encoded with the stdlib json module
+    orjson = None
+
 # Initialize the FastMCP server
 mcp = FastMCP("pr-agent")
 
-# PR template directory (shared across all modules)
-TEMPLATES_DIR = Path(__file__).parent.parent.parent / "templates"
+
+def _dumps(obj, pretty: bool = False) -> str:
+    """Encode a tool response as JSON, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode()
+    return json.dumps(obj, indent=2 if pretty else None)
+
+
+# PR template directory (shared across all modules), resolved once so filesystem
+# calls don't walk the ".." segments every time
+TEMPLATES_DIR = (Path(__file__).resolve().parent.parent.parent / "templates").resolve()
+TEMPLATES_DIR_STR = str(TEMPLATES_DIR)
+
+_TEMPLATES_MISSING_MESSAGE = f"Templates directory not found at {TEMPLATES_DIR_STR}"
+_TEMPLATES_NOT_DIR_ERROR = f"Templates path exists but is not a directory: {TEMPLATES_DIR_STR}"
+
+# Fixed-shape responses, serialized once instead of on every call
+_NO_ROOTS_JSON = _dumps({"error": "No workspace roots available"})
+_TEMPLATES_MISSING_JSON = _dumps({
+    "templates": [],
+    "template_count": 0,
+    "message": _TEMPLATES_MISSING_MESSAGE
+})
+_TEMPLATES_NOT_DIR_JSON = _dumps({"error": _TEMPLATES_NOT_DIR_ERROR})
+_TEMPLATES_UNLOADABLE_JSON = _dumps({
+    "error": "Could not load templates",
+    "details": _TEMPLATES_NOT_DIR_ERROR
+})
+_NO_TEMPLATES_JSON = _dumps({
+    "suggestion": None,
+    "message": "No templates available to suggest",
+    "templates_dir": TEMPLATES_DIR_STR
+})
+
+# Open pygit2 repositories, keyed by working directory, reused across tool calls
+_REPOSITORIES = {}
+
+# Recent analyze_file_changes responses, keyed by repository, commits and options (LRU)
+_DIFF_CACHE = collections.OrderedDict()
+_DIFF_CACHE_SIZE = 16
+
+# Diff text served through the pr://diff resource, keyed by resource URI (LRU)
+_DIFF_RESOURCES = collections.OrderedDict()
+
+# C-style escapes git uses in quoted paths; any other byte that needs escaping is written in octal
+_PATH_ESCAPES = {'\a': 'a', '\b': 'b', '\t': 't', '\n': 'n', '\v': 'v', '\f': 'f', '\r': 'r', '"': '"', '\\': '\\'}
+_PATH_UNESCAPES = {v: k for k, v in _PATH_ESCAPES.items()}
+_NEEDS_QUOTING_RE = re.compile(r'[\x00-\x1f"\\\x7f]')
+_QUOTED_PATH_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_PATH_ESCAPE_RE = re.compile(r'\\([0-7]{3}|.)')
+
+# Template name patterns for each change type
+_TYPE_PATTERNS: dict[str, tuple[str, ...]] = {
+    "bug": ("bug", "fix", "hotfix", "patch"),
+    "feature": ("feature", "enhancement", "new"),
+    "docs": ("docs", "documentation", "readme"),
+    "refactor": ("refactor", "cleanup", "improvement"),
+    "test": ("test", "testing", "spec"),
+    "chore": ("chore", "maintenance", "update"),
+    "breaking": ("breaking", "major"),
+    "security": ("security", "vulnerability", "cve")
+}
+
+# Template names that are suitable for any kind of change
+_GENERIC_TEMPLATE_RE = re.compile(r"default|general|standard|basic")
+
+# Workspace root per MCP session, so list_roots() is only requested once per client
+_ROOTS_CACHE = weakref.WeakKeyDictionary()
+
+# Template listing cache: templates dir -> (directory signature, templates)
+_TEMPLATES_CACHE = {}
+
+# Template files up to this size are read with a single os.read()
+_MAX_DIRECT_READ = 1 << 20
+
+# Last seen number of templates: templates dir -> (directory mtime, count)
+_TEMPLATE_COUNTS = {}
+
+# A directory mtime this close to the time of a scan may not change again when the directory
+# does, on filesystems with coarse timestamps
+_RACY_MTIME_NS = 2 * 10**9
+
+
+async def _working_dir() -> str | None:
+    """Return the client's workspace root, asking the session for its roots only on first use."""
+    session = mcp.get_context().session
+    working_dir = _ROOTS_CACHE.get(session)
+    if working_dir:
+        return working_dir
+    
+    roots_result = await session.list_roots()
+    if not roots_result.roots:
+        return None
+    
+    # FileUrl object has a .path property that gives us the path directly
+    working_dir = roots_result.roots[0].uri.path
+    _ROOTS_CACHE[session] = working_dir
+    return working_dir
+
+
+def _forget_working_dir() -> None:
+    """Drop the cached workspace root for the current session, e.g. after the client's roots changed."""
+    _ROOTS_CACHE.pop(mcp.get_context().session, None)
+
+
+def _repository(repo_path: str) -> "pygit2.Repository":
+    """Open a pygit2 repository, reusing it across tool calls."""
+    repo = _REPOSITORIES.get(repo_path)
+    if repo is None:
+        repo = _REPOSITORIES[repo_path] = pygit2.Repository(repo_path)
+    return repo
+
+
+def _resolve_commits_pygit2(repo_path: str, base: str) -> tuple[str, str]:
+    """Resolve the base branch and HEAD to commit SHAs with pygit2."""
+    repo = _repository(repo_path)
+    return str(repo.revparse_single(base).peel(pygit2.Commit).id), str(repo.head.target)
+
+
+def _quote_path(path: str) -> str:
+    """Quote a path the way git does with core.quotepath=off, leaving non-ASCII characters as they are."""
+    if not _NEEDS_QUOTING_RE.search(path):
+        return path
+    return '"' + _NEEDS_QUOTING_RE.sub(
+        lambda m: '\\' + _PATH_ESCAPES.get(m.group(), f"{ord(m.group()):03o}"), path
+    ) + '"'
+
+
+def _unquote_path(quoted: str) -> str:
+    """Undo libgit2's path quoting, which also writes every non-ASCII byte as an octal escape."""
+    raw = _PATH_ESCAPE_RE.sub(
+        lambda m: chr(int(m.group(1), 8)) if len(m.group(1)) == 3 else _PATH_UNESCAPES.get(m.group(1), m.group(1)),
+        quoted
+    )
+    return raw.encode('latin-1').decode('utf-8', errors='replace')
+
+
+def _patch_text(patch: "pygit2.Patch") -> str:
+    """Return a patch's text with its header paths quoted as `git -c core.quotepath=off diff` writes them."""
+    text = patch.data.decode('utf-8', errors='replace')
+    
+    # Only the header holds paths; quotes in the hunks are file content
+    end = text.find('\n@@')
+    header, hunks = (text, "") if end == -1 else (text[:end + 1], text[end + 1:])
+    header = _QUOTED_PATH_RE.sub(lambda m: _quote_path(_unquote_path(m.group(1))), header)
+    
+    # git ends ---/+++ lines with a tab when the name has a space in it, libgit2 doesn't
+    lines = header.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith(('--- ', '+++ ')) and ' ' in line[4:]:
+            lines[i] = line + '\t'
+    return '\n'.join(lines) + hunks
+
+
+def _stat_name(old_path: str, new_path: str) -> str:
+    """Format a file name for the stat block, writing renames as git does: "dir/{old => new}"."""
+    if old_path == new_path:
+        return _quote_path(new_path)
+    
+    # Names that need quoting are written out in full
+    if _NEEDS_QUOTING_RE.search(old_path) or _NEEDS_QUOTING_RE.search(new_path):
+        return f"{_quote_path(old_path)} => {_quote_path(new_path)}"
+    
+    # Common prefix and suffix, both cut at a path separator
+    prefix = 0
+    for i, (a, b) in enumerate(zip(old_path, new_path)):
+        if a != b:
+            break
+        if a == '/':
+            prefix = i + 1
+    
+    suffix = 0
+    limit = min(len(old_path), len(new_path)) - max(prefix - 1, 0)
+    for i in range(1, limit + 1):
+        if old_path[-i] != new_path[-i]:
+            break
+        if old_path[-i] == '/':
+            suffix = i
+    
+    old_mid = old_path[prefix:len(old_path) - suffix]
+    new_mid = new_path[prefix:len(new_path) - suffix]
+    if not prefix + suffix:
+        return f"{old_mid} => {new_mid}"
+    return f"{old_path[:prefix]}{{{old_mid} => {new_mid}}}{old_path[len(old_path) - suffix:]}"
+
+
+def _format_stat(files: list[tuple[str, int, int, bool]], width: int = 80) -> str:
+    """Lay out a `git diff --stat` block, including git's scaling of names and +/- graphs.
+    
+    Args:
+        files: (name, added, deleted, is_binary) per file; binary files carry the old and
+            new blob sizes in place of the deleted and added line counts
+        width: Total line width, 80 as git uses when not writing to a terminal
+    """
+    if not files:
+        return ""
+    
+    max_len = max(len(name) for name, _, _, _ in files)
+    max_change = max((added + deleted for _, added, deleted, binary in files if not binary), default=0)
+    bin_width = max(
+        (14 + len(str(added)) + len(str(deleted)) for _, added, deleted, binary in files if binary),
+        default=0
+    )
+    number_width = max(len(str(max_change)), 3 if bin_width else 0)
+    width = max(width, 16 + 6 + number_width)
+    
+    graph_width = max_change if max_change + 4 > bin_width else bin_width - 4
+    name_width = max_len
+    if name_width + number_width + 6 + graph_width > width:
+        if graph_width > width * 3 // 8 - number_width - 6:
+            graph_width = max(width * 3 // 8 - number_width - 6, 6)
+        if name_width > width - number_width - 6 - graph_width:
+            name_width = width - number_width - 6 - graph_width
+        else:
+            graph_width = width - number_width - 6 - name_width
+    
+    def scale(count: int) -> int:
+        return 1 + count * (graph_width - 1) // max_change if count else 0
+    
+    lines = []
+    insertions = deletions = 0
+    for name, added, deleted, binary in files:
+        if len(name) > name_width:
+            # Keep the end of the name, starting at a directory boundary if there is one
+            name = name[len(name) - max(name_width - 3, 0):]
+            slash = name.find('/')
+            name = "..." + (name[slash:] if slash != -1 else name)
+        name = name.ljust(name_width)
+        
+        if binary:
+            line = f" {name} | {'Bin':>{number_width}}"
+            if added or deleted:
+                line += f" {deleted} -> {added} bytes"
+            lines.append(line)
+            continue
+        
+        insertions += added
+        deletions += deleted
+        plus, minus = added, deleted
+        if graph_width <= max_change:
+            total = max(scale(added + deleted), 2 if added and deleted else 0)
+            if added < deleted:
+                plus = scale(added)
+                minus = total - plus
+            else:
+                minus = scale(deleted)
+                plus = total - minus
+        
+        changes = added + deleted
+        lines.append(f" {name} | {changes:>{number_width}}{' ' if changes else ''}{'+' * plus}{'-' * minus}")
+    
+    summary = f" {len(files)} file{'s' if len(files) != 1 else ''} changed"
+    if insertions or not deletions:
+        summary += f", {insertions} insertion{'s' if insertions != 1 else ''}(+)"
+    if deletions or not insertions:
+        summary += f", {deletions} deletion{'s' if deletions != 1 else ''}(-)"
+    lines.append(summary)
+    return "\n".join(lines)
+
+
+def _compute_diff(
+    repo_path: str,
+    base_sha: str,
+    head_sha: str,
+    include_diff: bool = True,
+    max_lines: int = 500
+) -> tuple[list[str], str, str, bool]:
+    """Compute the changed files, diff stats and patch for base...head in-process with pygit2.
+    
+    Only the patches needed for the first max_lines lines are kept, so memory doesn't grow
+    with the size of the diff.
+    
+    Returns:
+        Tuple of (changed_files, stats, diff, truncated); diff is empty unless include_diff is set
+    """
+    repo = _repository(repo_path)
+    
+    # Three-dot semantics: compare head against its merge base with the base commit
+    merge_base = repo.merge_base(base_sha, head_sha)
+    if merge_base is None:
+        raise ValueError(f"{base_sha}...{head_sha}: no merge base")
+    
+    diff = repo.diff(repo[merge_base], repo[head_sha], context_lines=3)
+    diff.find_similar()
+    
+    changed_files = []
+    stat_files = []
+    patches = []
+    patch_lines = 0
+    for patch in diff:
+        delta = patch.delta
+        # Decode names as the git CLI backend does, so non-UTF-8 bytes don't become surrogates
+        old_path = delta.old_file.raw_path.decode('utf-8', errors='replace')
+        new_path = delta.new_file.raw_path.decode('utf-8', errors='replace')
+        changed_files.append(new_path)
+        name = _stat_name(old_path, new_path)
+        if delta.is_binary:
+            stat_files.append((name, delta.new_file.size, delta.old_file.size, True))
+        else:
+            _, additions, deletions = patch.line_stats
+            stat_files.append((name, additions, deletions, False))
+        
+        # One patch past the limit is enough to tell that the diff was truncated
+        if include_diff and patch_lines <= max_lines:
+            text = _patch_text(patch)
+            patches.append(text)
+            patch_lines += text.count('\n')
+    
+    # libgit2's own stats formatting doesn't scale the +/- graph like git does
+    stats = _format_stat(stat_files).strip()
+    diff_text, truncated = _truncate_diff("".join(patches), max_lines)
+    return changed_files, stats, diff_text, truncated
+
+
+def _truncate_diff(diff: str, max_lines: int) -> tuple[str, bool]:
+    """Cut a diff down to its first max_lines lines without splitting the whole string.
+    
+    Returns:
+        Tuple of (diff, truncated); a diff of at most max_lines lines is returned unchanged
+    """
+    if max_lines <= 0:
+        return "", bool(diff)
+    
+    # Scan forward to the newline ending line max_lines; only the kept prefix is copied
+    end = -1
+    for _ in range(max_lines):
+        end = diff.find('\n', end + 1)
+        if end == -1:
+            return diff, False
+    
+    if end == len(diff) - 1:
+        # Exactly max_lines lines
+        return diff, False
+    return diff[:end], True
+
+
+async def _git(cwd: str, *args: str) -> tuple[int, str, str]:
+    """Run a git command without blocking the event loop.
+    
+    Returns:
+        Tuple of (returncode, stdout, stderr)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "git", "-c", "core.quotepath=off", *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await proc.communicate()
+    return proc.returncode, stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace')
+
+
+async def _resolve_commits(working_dir: str, base_branch: str) -> tuple[str, str]:
+    """Resolve the base branch and HEAD to commit SHAs.
+    
+    Raises:
+        ValueError: If either revision can't be resolved
+    """
+    if pygit2 is not None:
+        try:
+            return await asyncio.to_thread(_resolve_commits_pygit2, working_dir, base_branch)
+        except KeyError as e:
+            # revparse_single() raises KeyError with just the revision as its message
+            raise ValueError(f"Unknown revision: {base_branch}") from e
+        except pygit2.GitError as e:
+            raise ValueError(str(e)) from e
+    
+    returncode, output, stderr = await _git(working_dir, "rev-parse", f"{base_branch}^{{commit}}", "HEAD")
+    if returncode != 0:
+        raise ValueError(stderr.strip())
+    
+    base_sha, head_sha = output.split()
+    return base_sha, head_sha
+
+
+def _diff_uri(base_sha: str, head_sha: str, max_lines: int | str) -> str:
+    """Build the pr://diff resource URI for a diff of base...head cut at max_lines."""
+    return f"pr://diff/{base_sha}/{head_sha}/{max_lines}"
+
+
+def _publish_diff(base_sha: str, head_sha: str, max_lines: int, diff: str) -> str:
+    """Store a diff for the pr://diff resource and return its URI."""
+    uri = _diff_uri(base_sha, head_sha, max_lines)
+    _DIFF_RESOURCES[uri] = diff
+    _DIFF_RESOURCES.move_to_end(uri)
+    if len(_DIFF_RESOURCES) > _DIFF_CACHE_SIZE:
+        _DIFF_RESOURCES.popitem(last=False)
+    return uri
+
+
+async def _stream_diff(cwd: str, args: list[str], max_lines: int) -> tuple[int, str, str, bool, str]:
+    """Run a `git diff --stat [--patch]` command, keeping only the stats and the first max_lines patch lines.
+    
+    Once more than max_lines patch lines have arrived git is stopped, so neither memory nor time
+    grows with the size of the diff.
+    
+    Returns:
+        Tuple of (returncode, stats, diff, truncated, stderr)
+    """
+    proc = await asyncio.create_subprocess_exec(
+        "git", "-c", "core.quotepath=off", *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    buf = bytearray()
+    patch_start = -1  # Offset of the patch in buf, once the blank line after the stats has arrived
+    # Without --patch there is only the stat block, which has no line limit
+    has_patch = "--patch" in args
+    
+    async def read_stdout() -> bool:
+        nonlocal patch_start
+        patch_lines = 0
+        while chunk := await proc.stdout.read(1 << 16):
+            buf.extend(chunk)
+            if not has_patch:
+                continue
+            if patch_start == -1:
+                # Only search the new chunk, plus one byte in case the separator straddles chunks
+                separator = buf.find(b'\n\n', max(0, len(buf) - len(chunk) - 1))
+                if separator == -1:
+                    continue
+                patch_start = separator + 2
+                patch_lines = buf.count(b'\n', patch_start)
+            else:
+                patch_lines += chunk.count(b'\n')
+            
+            if patch_lines > max_lines or (patch_lines == max_lines and not buf.endswith(b'\n')):
+                # There is more than we will return; stop git instead of reading the rest.
+                # os.kill rather than proc.terminate(): terminate() polls the child first and can
+                # reap it behind the event loop's child watcher if git has just exited.
+                if proc.returncode is None:
+                    try:
+                        os.kill(proc.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                return True
+        return False
+    
+    # Drain stderr alongside stdout so neither pipe can fill up and stall git
+    truncated, stderr = await asyncio.gather(read_stdout(), proc.stderr.read())
+    returncode = await proc.wait()
+    if truncated:
+        # git was stopped by us, not by an error
+        returncode = 0
+    
+    stats, _, patch = buf.decode('utf-8', errors='replace').partition('\n\n')
+    diff, _ = _truncate_diff(patch, max_lines)
+    return returncode, stats, diff, truncated, stderr.decode('utf-8', errors='replace')
 
 
 # TODO: Implement tool functions here
@@ -35,48 +503,97 @@ TEMPLATES_DIR = Path(__file__).parent.parent.parent / "templates"
 # TODO: Replace these with your actual implementations
 
 @mcp.tool()
-async def analyze_file_changes(base_branch: str = "main", include_diff: bool = True, max_diff_lines: int = 500) -> str:
+async def analyze_file_changes(
+    base_branch: str = "main",
+    include_diff: bool = True,
+    max_diff_lines: int = 500,
+    diff_as_resource: bool = False
+) -> str:
     """Get the full diff and list of changed files in the current git repository.
     
     Args:
         base_branch: Base branch to compare against (default: main)
         include_diff: Include the full diff content (default: true)
         max_diff_lines: Maximum number of diff lines to include (default: 500)
+        diff_as_resource: Return a pr://diff resource URI to read the diff from instead of
+            embedding it in the response (default: false)
     """
     try:
         # Get Claude's working directory from MCP context
-        context = mcp.get_context()
-        roots_result = await context.session.list_roots()
-        if not roots_result.roots:
-            return json.dumps({"error": "No workspace roots available"})
+        working_dir = await _working_dir()
+        if working_dir is None:
+            return _NO_ROOTS_JSON
         
-        working_dir = roots_result.roots[0].uri.path
-        
-        # Get list of changed files
-        files_result = subprocess.run(
-            ["git", "diff", "--name-only", f"{base_branch}...HEAD"],
-            cwd=working_dir,
-            capture_output=True,
-            text=True
-        )
-        
-        if files_result.returncode != 0:
-            return json.dumps({
+        try:
+            base_sha, head_sha = await _resolve_commits(working_dir, base_branch)
+        except ValueError as e:
+            # The cached root may be stale if the client's roots changed
+            _forget_working_dir()
+            return _dumps({
                 "error": "Failed to get changed files",
-                "details": files_result.stderr.strip()
+                "details": str(e)
             })
         
-        changed_files = [f.strip() for f in files_result.stdout.split('\n') if f.strip()]
+        # The diff only changes when one of the two commits moves
+        cache_key = (working_dir, base_branch, base_sha, head_sha, include_diff, max_diff_lines, diff_as_resource)
+        cached = _DIFF_CACHE.get(cache_key)
+        if cached is not None and include_diff and diff_as_resource:
+            # A cached response is only usable while the diff it points to is still published
+            if _diff_uri(base_sha, head_sha, max_diff_lines) not in _DIFF_RESOURCES:
+                cached = None
+        if cached is not None:
+            _DIFF_CACHE.move_to_end(cache_key)
+            return cached
         
-        # Get diff statistics
-        stats_result = subprocess.run(
-            ["git", "diff", "--stat", f"{base_branch}...HEAD"],
-            cwd=working_dir,
-            capture_output=True,
-            text=True
-        )
+        diff_error = None
         
-        stats = stats_result.stdout.strip() if stats_result.returncode == 0 else "Stats unavailable"
+        if pygit2 is not None:
+            try:
+                # pygit2 calls block, so keep them off the event loop
+                changed_files, stats, diff_content, truncated = await asyncio.to_thread(
+                    _compute_diff, working_dir, base_sha, head_sha, include_diff, max_diff_lines
+                )
+            except (KeyError, ValueError, pygit2.GitError) as e:
+                _forget_working_dir()
+                return _dumps({
+                    "error": "Failed to get changed files",
+                    "details": str(e)
+                })
+        else:
+            # Use the resolved commits so git doesn't look the refs up again, and so
+            # both calls see the same commits even if HEAD moves meanwhile
+            commit_range = f"{base_sha}...{head_sha}"
+            
+            # Get diff statistics and, if requested, the diff itself from a single git call.
+            # With --patch the stat summary comes first, separated from the patch by a blank line.
+            diff_args = ["diff", "--stat"]
+            if include_diff:
+                diff_args.extend(["--patch", "--unified=3"])
+            
+            # Run both git calls concurrently; the list of changed files is NUL-separated,
+            # so names never need unquoting
+            files_result, diff_result = await asyncio.gather(
+                _git(working_dir, "diff", "--name-only", "-z", commit_range),
+                _stream_diff(working_dir, [*diff_args, commit_range], max_diff_lines)
+            )
+            
+            files_returncode, files_output, files_stderr = files_result
+            if files_returncode != 0:
+                # The cached root may be stale if the client's roots changed
+                _forget_working_dir()
+                return _dumps({
+                    "error": "Failed to get changed files",
+                    "details": files_stderr.strip()
+                })
+            
+            changed_files = [f for f in files_output.split('\0') if f]
+            returncode, stats_output, diff_content, truncated, stderr = diff_result
+            
+            if returncode == 0:
+                stats = stats_output.strip()
+            else:
+                stats = "Stats unavailable"
+                diff_error = stderr.strip()
         
         result = {
             "changed_files": changed_files,
@@ -87,91 +604,214 @@ async def analyze_file_changes(base_branch: str = "main", include_diff: bool = T
         
         # Include diff content if requested
         if include_diff:
-            diff_result = subprocess.run(
-                ["git", "diff", f"{base_branch}...HEAD"],
-                cwd=working_dir,
-                capture_output=True,
-                text=True
-            )
-            
-            if diff_result.returncode == 0:
-                diff_lines = diff_result.stdout.split('\n')
-                
-                if len(diff_lines) > max_diff_lines:
-                    truncated_diff = '\n'.join(diff_lines[:max_diff_lines])
-                    result["diff"] = truncated_diff
-                    result["diff_truncated"] = True
-                    result["total_diff_lines"] = len(diff_lines)
-                    result["truncation_message"] = f"Diff truncated to {max_diff_lines} lines (total: {len(diff_lines)} lines)"
+            if diff_error is None:
+                if diff_as_resource:
+                    # Clients read the text from the resource instead of unescaping it from this JSON
+                    result["diff_resource"] = _publish_diff(base_sha, head_sha, max_diff_lines, diff_content)
                 else:
-                    result["diff"] = diff_result.stdout
-                    result["diff_truncated"] = False
+                    result["diff"] = diff_content
+                
+                result["diff_truncated"] = truncated
+                if truncated:
+                    # Reading stops at the line limit, so the full length of the diff is unknown
+                    result["truncation_message"] = f"Diff truncated to {max_diff_lines} lines"
             else:
-                result["diff_error"] = diff_result.stderr.strip()
+                result["diff_error"] = diff_error
+        
+        response = _dumps(result, pretty=True)
         
-        return json.dumps(result, indent=2)
+        if diff_error is None:
+            _DIFF_CACHE[cache_key] = response
+            if len(_DIFF_CACHE) > _DIFF_CACHE_SIZE:
+                _DIFF_CACHE.popitem(last=False)
+        
+        return response
         
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "error": "Unexpected error occurred",
             "details": str(e)
         })
 
 
-@mcp.tool()
-async def get_pr_templates() -> str:
-    """List available PR templates with their content."""
+def _read_text(path: str, size: int) -> str:
+    """Read a small UTF-8 text file with read() calls sized from its stat result.
+    
+    Normally this is a single read(), plus the empty one that finds EOF. Files larger than
+    _MAX_DIRECT_READ go through the regular buffered reader instead.
+    """
+    if size > _MAX_DIRECT_READ:
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    
+    fd = os.open(path, os.O_RDONLY)
     try:
-        if not TEMPLATES_DIR.exists():
-            return json.dumps({
-                "templates": [],
-                "template_count": 0,
-                "message": f"Templates directory not found at {TEMPLATES_DIR}"
+        # read() may return fewer bytes than asked for, and the file may have grown since it
+        # was stat'ed, so keep going until EOF; for an unchanged file that's one empty read()
+        data = os.read(fd, size)
+        while chunk := os.read(fd, max(size - len(data), 1 << 16)):
+            data += chunk
+    finally:
+        os.close(fd)
+    
+    # A file that ends mid-character fails to decode, like it would with open()
+    text = data.decode('utf-8')
+    
+    # Match the newline translation of text-mode open()
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text
+
+
+def _template_entries() -> list[os.DirEntry]:
+    """List the files in the templates directory; DirEntry caches its stat results."""
+    with os.scandir(TEMPLATES_DIR_STR) as it:
+        return [entry for entry in it if entry.is_file()]
+
+
+def _templates_signature(entries: list[os.DirEntry]) -> int:
+    """Hash the name, mtime and size of every template file to detect changes cheaply."""
+    return hash(tuple(sorted(
+        (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries
+    )))
+
+
+def _load_templates(include_content: bool = True) -> list[dict]:
+    """Read all templates, reusing the cached list while the templates directory is unchanged.
+    
+    Args:
+        include_content: Read each template's content; otherwise only name, path, size (in
+            bytes) and the pr://templates resource URI for the content are listed
+    """
+    entries = _template_entries()
+    
+    if not include_content:
+        # Metadata only comes straight from the directory listing, no files are opened
+        return sorted(
+            (
+                {
+                    "name": entry.name,
+                    "path": entry.name,
+                    "size": entry.stat().st_size,
+                    "content_resource": f"pr://templates/{entry.name}"
+                }
+                for entry in entries
+            ),
+            key=lambda x: x["name"]
+        )
+    
+    signature = _templates_signature(entries)
+    cached = _TEMPLATES_CACHE.get(TEMPLATES_DIR)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    
+    templates = []
+    
+    # Read all template files (commonly .md files); the directory is flat, so name == path
+    for entry in entries:
+        try:
+            size = entry.stat().st_size
+            content = _read_text(entry.path, size)
+            
+            # Size in bytes, the same as in the metadata-only listing
+            templates.append({
+                "name": entry.name,
+                "path": entry.name,
+                "content": content,
+                "size": size
             })
-        
-        if not TEMPLATES_DIR.is_dir():
-            return json.dumps({
-                "error": f"Templates path exists but is not a directory: {TEMPLATES_DIR}"
+        except Exception as e:
+            templates.append({
+                "name": entry.name,
+                "path": entry.name,
+                "error": f"Failed to read file: {str(e)}"
             })
+    
+    # Sort templates by name for consistent ordering
+    templates.sort(key=lambda x: x["name"])
+    
+    _TEMPLATES_CACHE[TEMPLATES_DIR] = (signature, templates)
+    return templates
+
+
+async def _gather_templates(include_content: bool = True) -> tuple[list[dict], dict]:
+    """Collect the available templates for the MCP tools without serializing them.
+    
+    Args:
+        include_content: Include each template's content (default: true)
+    
+    Returns:
+        Tuple of (templates, meta); meta holds a message or error if the templates
+        directory could not be used, and is empty otherwise
+    """
+    try:
+        dir_stat = os.stat(TEMPLATES_DIR_STR)
+    except OSError:
+        return [], {"message": _TEMPLATES_MISSING_MESSAGE}
+    
+    if not stat.S_ISDIR(dir_stat.st_mode):
+        return [], {"error": _TEMPLATES_NOT_DIR_ERROR}
+    
+    templates = _load_templates(include_content)
+    # Only remember the count once the directory's mtime is safely in the past (racy timestamps)
+    if time.time_ns() - dir_stat.st_mtime_ns > _RACY_MTIME_NS:
+        _TEMPLATE_COUNTS[TEMPLATES_DIR] = (dir_stat.st_mtime_ns, len(templates))
+    else:
+        _TEMPLATE_COUNTS.pop(TEMPLATES_DIR, None)
+    return templates, {}
+
+
+def _known_template_count() -> int | None:
+    """Return the last seen number of templates, or None if the directory may have changed since."""
+    known = _TEMPLATE_COUNTS.get(TEMPLATES_DIR)
+    if known is None:
+        return None
+    
+    try:
+        mtime = os.stat(TEMPLATES_DIR_STR).st_mtime_ns
+    except OSError:
+        return None
+    
+    # Adding or removing a file updates the directory's mtime
+    return known[1] if known[0] == mtime else None
+
+
+@mcp.tool()
+async def get_pr_templates(include_content: bool = True) -> str:
+    """List available PR templates with their content.
+    
+    Args:
+        include_content: Include the content of each template; when false each template
+            links to a pr://templates resource for its content instead (default: true)
+    """
+    try:
+        templates, meta = await _gather_templates(include_content)
         
-        templates = []
-        
-        # Read all template files (commonly .md files)
-        for template_file in TEMPLATES_DIR.glob("*"):
-            if template_file.is_file():
-                try:
-                    with open(template_file, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    templates.append({
-                        "name": template_file.name,
-                        "path": str(template_file.relative_to(TEMPLATES_DIR)),
-                        "content": content,
-                        "size": len(content)
-                    })
-                except Exception as e:
-                    templates.append({
-                        "name": template_file.name,
-                        "path": str(template_file.relative_to(TEMPLATES_DIR)),
-                        "error": f"Failed to read file: {str(e)}"
-                    })
+        if "error" in meta:
+            return _TEMPLATES_NOT_DIR_JSON
         
-        # Sort templates by name for consistent ordering
-        templates.sort(key=lambda x: x["name"])
+        if "message" in meta:
+            return _TEMPLATES_MISSING_JSON
         
-        return json.dumps({
+        return _dumps({
             "templates": templates,
             "template_count": len(templates),
-            "templates_dir": str(TEMPLATES_DIR)
-        }, indent=2)
+            "templates_dir": TEMPLATES_DIR_STR
+        }, pretty=True)
         
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "error": "Unexpected error occurred while reading templates",
             "details": str(e)
         })
 
 
+@functools.lru_cache(maxsize=32)
+def _compile_patterns(patterns: tuple[str, ...]) -> re.Pattern:
+    """Compile template name patterns into a single alternation regex."""
+    return re.compile("|".join(re.escape(pattern) for pattern in patterns))
+
+
 @mcp.tool()
 async def suggest_template(changes_summary: str, change_type: str) -> str:
     """Let Claude analyze the changes and suggest the most appropriate PR template.
@@ -181,63 +821,43 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
         change_type: The type of change you've identified (bug, feature, docs, refactor, test, etc.)
     """
     try:
-        # First, get available templates
-        templates_response = await get_pr_templates()
-        templates_data = json.loads(templates_response)
+        # Nothing to suggest from a templates directory that was empty and hasn't changed
+        if _known_template_count() == 0:
+            return _NO_TEMPLATES_JSON
         
-        if "error" in templates_data:
-            return json.dumps({
-                "error": "Could not load templates",
-                "details": templates_data["error"]
-            })
+        # First, get available templates; only names and paths are needed for matching
+        available_templates, meta = await _gather_templates(include_content=False)
         
-        available_templates = templates_data.get("templates", [])
+        if "error" in meta:
+            return _TEMPLATES_UNLOADABLE_JSON
         
         if not available_templates:
-            return json.dumps({
-                "suggestion": None,
-                "message": "No templates available to suggest",
-                "templates_dir": templates_data.get("templates_dir", str(TEMPLATES_DIR))
-            })
-        
-        # Define mapping from change types to template patterns
-        type_mappings = {
-            "bug": ["bug", "fix", "hotfix", "patch"],
-            "feature": ["feature", "enhancement", "new"],
-            "docs": ["docs", "documentation", "readme"],
-            "refactor": ["refactor", "cleanup", "improvement"],
-            "test": ["test", "testing", "spec"],
-            "chore": ["chore", "maintenance", "update"],
-            "breaking": ["breaking", "major"],
-            "security": ["security", "vulnerability", "cve"]
-        }
+            return _NO_TEMPLATES_JSON
         
         # Find matching templates based on change type
         matching_templates = []
         change_type_lower = change_type.lower()
         
-        # Direct match or pattern match
-        patterns_to_check = type_mappings.get(change_type_lower, [change_type_lower])
+        # Direct match or pattern match, all patterns checked in a single regex search
+        patterns_re = _compile_patterns(_TYPE_PATTERNS.get(change_type_lower, (change_type_lower,)))
         
         for template in available_templates:
-            template_name_lower = template["name"].lower()
-            
-            # Check if any pattern matches the template name
-            for pattern in patterns_to_check:
-                if pattern in template_name_lower:
-                    matching_templates.append({
-                        **template,
-                        "match_reason": f"Template name contains '{pattern}' which matches change type '{change_type}'"
-                    })
-                    break
+            match = patterns_re.search(template["name"].lower())
+            if match:
+                matching_templates.append({
+                    "name": template["name"],
+                    "path": template["path"],
+                    "match_reason": f"Template name contains '{match.group(0)}' which matches change type '{change_type}'"
+                })
         
         # If no direct matches, look for generic templates
         if not matching_templates:
             for template in available_templates:
                 template_name_lower = template["name"].lower()
-                if any(generic in template_name_lower for generic in ["default", "general", "standard", "basic"]):
+                if _GENERIC_TEMPLATE_RE.search(template_name_lower):
                     matching_templates.append({
-                        **template,
+                        "name": template["name"],
+                        "path": template["path"],
                         "match_reason": f"Generic template suitable for '{change_type}' changes"
                     })
         
@@ -249,30 +869,18 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
                 t["name"]  # Then alphabetical
             ))
             
-            best_match = matching_templates[0]
-            
-            return json.dumps({
-                "suggested_template": {
-                    "name": best_match["name"],
-                    "path": best_match["path"],
-                    "match_reason": best_match["match_reason"]
-                },
+            # Matches already carry only name, path and match_reason
+            return _dumps({
+                "suggested_template": matching_templates[0],
                 "change_type": change_type,
                 "changes_summary": changes_summary,
-                "all_matches": [
-                    {
-                        "name": t["name"],
-                        "path": t["path"],
-                        "match_reason": t["match_reason"]
-                    }
-                    for t in matching_templates
-                ],
+                "all_matches": matching_templates,
                 "total_available_templates": len(available_templates)
-            }, indent=2)
+            }, pretty=True)
         else:
             # No matches found, suggest first available template
             fallback_template = available_templates[0]
-            return json.dumps({
+            return _dumps({
                 "suggested_template": {
                     "name": fallback_template["name"],
                     "path": fallback_template["path"],
@@ -283,14 +891,40 @@ async def suggest_template(changes_summary: str, change_type: str) -> str:
                 "all_matches": [],
                 "total_available_templates": len(available_templates),
                 "note": f"Consider creating a template specifically for '{change_type}' changes"
-            }, indent=2)
+            }, pretty=True)
             
     except Exception as e:
-        return json.dumps({
+        return _dumps({
             "error": "Unexpected error occurred while suggesting template",
             "details": str(e)
         })
 
 
+@mcp.resource("pr://diff/{base_sha}/{head_sha}/{max_lines}", mime_type="text/x-diff")
+async def diff_resource(base_sha: str, head_sha: str, max_lines: str) -> str:
+    """Diff text returned by analyze_file_changes with diff_as_resource=true."""
+    diff = _DIFF_RESOURCES.get(_diff_uri(base_sha, head_sha, max_lines))
+    if diff is None:
+        raise ValueError("Diff is no longer available; call analyze_file_changes again")
+    return diff
+
+
+@mcp.resource("pr://templates/{name}", mime_type="text/markdown")
+async def template_resource(name: str) -> str:
+    """Content of a single PR template."""
+    # Only a name from the directory listing is opened, so it can't point outside the directory
+    try:
+        entry = next((entry for entry in _template_entries() if entry.name == name), None)
+    except OSError:
+        entry = None
+    if entry is None:
+        raise ValueError(f"Template not found: {name}")
+    
+    try:
+        return _read_text(entry.path, entry.stat().st_size)
+    except Exception as e:
+        raise ValueError(f"Failed to read file: {str(e)}") from e
+
+
 if __name__ == "__main__":
     mcp.run()
\ No newline at end of file
@@ -4,14 +4,19 @@ Unit tests for Module 1: Basic MCP Server
 Run these tests to validate your implementation
 """
 
+import collections
 import json
+import os
+import signal
+import subprocess
 import pytest
 import asyncio
 from pathlib import Path
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, AsyncMock, MagicMock
 
 # Import your implemented functions
 try:
+    import server
     from server import (
         mcp,
         analyze_file_changes,
@@ -24,6 +29,60 @@ except ImportError as e:
     IMPORT_ERROR = str(e)
 
 
+def run_git(cwd, *args):
+    """Run a git command for test setup and return its output."""
+    return subprocess.run(["git", *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+@pytest.fixture
+def git_repo(tmp_path):
+    """A repository with a "feature" branch checked out one commit ahead of "main"."""
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    run_git(repo, "init", "-q", "-b", "main")
+    run_git(repo, "config", "user.email", "test@example.com")
+    run_git(repo, "config", "user.name", "Test")
+    (repo / "README.md").write_text("# Test\n")
+    run_git(repo, "add", "-A")
+    run_git(repo, "commit", "-q", "-m", "Initial commit")
+    
+    run_git(repo, "checkout", "-q", "-b", "feature")
+    (repo / "README.md").write_text("# Test\n\nMore docs\n")
+    # Large enough that git can't write the whole diff into the pipe before it is read
+    (repo / "big.txt").write_text("".join(f"line {i}\n" for i in range(100000)))
+    run_git(repo, "add", "-A")
+    run_git(repo, "commit", "-q", "-m", "Add feature")
+    return repo
+
+
+@pytest.fixture(params=["git", "pygit2"])
+def workspace(request, git_repo, monkeypatch):
+    """Make git_repo the client's workspace root, diffed with the git CLI or with pygit2."""
+    if request.param == "git":
+        monkeypatch.setattr(server, "pygit2", None)
+    elif server.pygit2 is None:
+        pytest.skip("pygit2 is not installed")
+    
+    root = MagicMock()
+    root.uri.path = str(git_repo)
+    context = MagicMock()
+    context.session.list_roots = AsyncMock(return_value=MagicMock(roots=[root]))
+    monkeypatch.setattr(server.mcp, "get_context", lambda: context)
+    monkeypatch.setattr(server, "_DIFF_CACHE", collections.OrderedDict())
+    monkeypatch.setattr(server, "_DIFF_RESOURCES", collections.OrderedDict())
+    return git_repo
+
+
+@pytest.fixture
+def templates_dir(tmp_path, monkeypatch):
+    """An empty templates directory in place of the shared one."""
+    path = tmp_path / "templates"
+    path.mkdir()
+    monkeypatch.setattr(server, "TEMPLATES_DIR", path)
+    monkeypatch.setattr(server, "TEMPLATES_DIR_STR", str(path))
+    return path
+
+
 class TestImplementation:
     """Test that the required functions are implemented."""
     
@@ -169,6 +228,379 @@ class TestToolRegistration:
             "suggest_template should be a proper function"
 
 
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestTruncateDiff:
+    """Test cutting a diff down to max_diff_lines lines."""
+    
+    def test_short_diff_is_kept(self):
+        """Test that a diff shorter than the limit is returned unchanged."""
+        assert server._truncate_diff("a\nb\n", 5) == ("a\nb\n", False)
+    
+    def test_exactly_max_lines(self):
+        """Test that a diff of exactly max_lines lines is not reported as truncated."""
+        assert server._truncate_diff("a\nb\nc\n", 3) == ("a\nb\nc\n", False)
+        assert server._truncate_diff("a\nb\nc", 3) == ("a\nb\nc", False)
+    
+    def test_long_diff_is_cut(self):
+        """Test that only the first max_lines lines are kept."""
+        assert server._truncate_diff("a\nb\nc\nd\n", 2) == ("a\nb", True)
+    
+    def test_zero_lines(self):
+        """Test that max_lines=0 keeps nothing, and only a non-empty diff counts as truncated."""
+        assert server._truncate_diff("a\n", 0) == ("", True)
+        assert server._truncate_diff("", 0) == ("", False)
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestStreamDiff:
+    """Test reading `git diff --stat --patch` output up to the line limit."""
+    
+    @pytest.fixture
+    def kills(self, monkeypatch):
+        """Record the signals sent to git."""
+        sent = []
+        real_kill = os.kill
+        
+        def kill(pid, sig):
+            sent.append(sig)
+            real_kill(pid, sig)
+        
+        monkeypatch.setattr(server.os, "kill", kill)
+        return sent
+    
+    @pytest.mark.asyncio
+    async def test_splits_stats_from_patch(self, git_repo, kills):
+        """Test that the stat block and the patch are separated, and a diff that fits is read whole."""
+        expected_stats = run_git(git_repo, "diff", "--stat", "main...HEAD")
+        expected_diff = run_git(git_repo, "diff", "main...HEAD")
+        
+        returncode, stats, diff, truncated, _ = await server._stream_diff(
+            str(git_repo), ["diff", "--stat", "--patch", "main...HEAD"], expected_diff.count("\n")
+        )
+        
+        assert returncode == 0
+        assert stats == expected_stats.rstrip("\n")
+        assert diff == expected_diff
+        assert not truncated
+        assert kills == []
+    
+    @pytest.mark.asyncio
+    async def test_stops_git_at_line_limit(self, git_repo, kills):
+        """Test that git is stopped once the line limit is passed, without reporting an error."""
+        expected_diff = run_git(git_repo, "diff", "main...HEAD")
+        
+        returncode, stats, diff, truncated, _ = await server._stream_diff(
+            str(git_repo), ["diff", "--stat", "--patch", "main...HEAD"], 10
+        )
+        
+        assert returncode == 0
+        assert "2 files changed" in stats
+        assert diff == "\n".join(expected_diff.split("\n")[:10])
+        assert truncated
+        assert kills == [signal.SIGTERM]
+
+    @pytest.mark.asyncio
+    async def test_stats_only(self, git_repo, kills):
+        """Test that without --patch the whole stat block is read and the line limit doesn't apply."""
+        expected_stats = run_git(git_repo, "diff", "--stat", "main...HEAD")
+    
+        returncode, stats, diff, truncated, _ = await server._stream_diff(
+            str(git_repo), ["diff", "--stat", "main...HEAD"], 0
+        )
+    
+        assert returncode == 0
+        assert stats == expected_stats
+        assert diff == ""
+        assert not truncated
+        assert kills == []
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestReadText:
+    """Test that _read_text returns what open(path, encoding="utf-8").read() does."""
+    
+    @staticmethod
+    def read(path, size=None):
+        """Read path with _read_text, passing its current size unless told otherwise."""
+        return server._read_text(str(path), path.stat().st_size if size is None else size)
+    
+    def test_newlines(self, tmp_path):
+        """Test that CRLF and lone CR line endings are translated."""
+        path = tmp_path / "template.md"
+        path.write_bytes(b"crlf\r\nlone cr\rlf\n")
+    
+        assert self.read(path) == open(path, encoding="utf-8").read() == "crlf\nlone cr\nlf\n"
+    
+    def test_short_reads(self, tmp_path, monkeypatch):
+        """Test that a read() returning fewer bytes than asked for, mid-character, isn't taken as EOF."""
+        path = tmp_path / "template.md"
+        path.write_text("## Änderungen\n\n- überall\n", encoding="utf-8")
+        real_read = os.read
+        monkeypatch.setattr(server.os, "read", lambda fd, n: real_read(fd, min(n, 3)))
+    
+        assert self.read(path) == open(path, encoding="utf-8").read()
+    
+    def test_file_grew_after_stat(self, tmp_path):
+        """Test that a file that grew since it was stat'ed is read in full, even if the old size ends mid-character."""
+        path = tmp_path / "template.md"
+        path.write_text("né\n## More\n", encoding="utf-8")
+    
+        assert self.read(path, 2) == open(path, encoding="utf-8").read()
+    
+    def test_truncated_character(self, tmp_path):
+        """Test that a file ending mid-character fails to decode, as it does with open()."""
+        path = tmp_path / "template.md"
+        path.write_bytes("café".encode("utf-8")[:-1])
+    
+        with pytest.raises(UnicodeDecodeError):
+            open(path, encoding="utf-8").read()
+        with pytest.raises(UnicodeDecodeError):
+            self.read(path)
+    
+    def test_large_file(self, tmp_path):
+        """Test a file over _MAX_DIRECT_READ, which is read through open() instead."""
+        path = tmp_path / "template.md"
+        path.write_bytes(b"- item\r\n" * (server._MAX_DIRECT_READ // 8 + 1))
+    
+        assert path.stat().st_size > server._MAX_DIRECT_READ
+        assert self.read(path) == open(path, encoding="utf-8").read()
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestEmptyTemplatesShortCircuit:
+    """Test that suggest_template skips an empty templates directory only while it is unchanged."""
+    
+    @pytest.fixture
+    def gathered(self, monkeypatch):
+        """Record each time the templates are actually gathered."""
+        calls = []
+        gather_templates = server._gather_templates
+        
+        async def counting_gather_templates(*args, **kwargs):
+            calls.append(args)
+            return await gather_templates(*args, **kwargs)
+        
+        monkeypatch.setattr(server, "_gather_templates", counting_gather_templates)
+        return calls
+    
+    @pytest.mark.asyncio
+    async def test_invalidated_by_directory_change(self, templates_dir, gathered):
+        """Test that adding a template to the empty directory is seen on the next call."""
+        # An mtime well in the past, so the empty result can be trusted
+        mtime = templates_dir.stat().st_mtime_ns - 10 * 10**9
+        os.utime(templates_dir, ns=(mtime, mtime))
+        
+        assert json.loads(await suggest_template("Fixed a crash", "bug"))["suggestion"] is None
+        assert json.loads(await suggest_template("Fixed a crash", "bug"))["suggestion"] is None
+        assert len(gathered) == 1
+        
+        (templates_dir / "bug.md").write_text("## Bug Fix\n")
+        data = json.loads(await suggest_template("Fixed a crash", "bug"))
+        
+        assert len(gathered) == 2
+        assert data["suggested_template"]["name"] == "bug.md"
+    
+    @pytest.mark.asyncio
+    async def test_recent_mtime_not_trusted(self, templates_dir, gathered):
+        """Test that a template added without changing a just-modified directory's mtime is still seen."""
+        mtime = templates_dir.stat().st_mtime_ns
+        assert json.loads(await suggest_template("Fixed a crash", "bug"))["suggestion"] is None
+        
+        # As if the filesystem's timestamps were too coarse to tell the two changes apart
+        (templates_dir / "bug.md").write_text("## Bug Fix\n")
+        os.utime(templates_dir, ns=(mtime, mtime))
+        data = json.loads(await suggest_template("Fixed a crash", "bug"))
+        
+        assert len(gathered) == 2
+        assert data["suggested_template"]["name"] == "bug.md"
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffBackends:
+    """Test that both diff backends report main...HEAD exactly as the git CLI does."""
+    
+    @staticmethod
+    def git_diff(repo, *args):
+        """Run `git diff` on main...HEAD as the git CLI backend does, decoding names the same way."""
+        return subprocess.run(
+            ["git", "-c", "core.quotepath=off", "diff", *args, "main...HEAD"],
+            cwd=repo, check=True, capture_output=True
+        ).stdout.decode("utf-8", errors="replace")
+    
+    def assert_matches_git(self, repo, data):
+        """Check an analyze_file_changes response against the git CLI's own output."""
+        assert data["changed_files"] == [f for f in self.git_diff(repo, "--name-only", "-z").split("\0") if f]
+        assert data["stats"] == self.git_diff(repo, "--stat").strip()
+        assert data["diff"] == self.git_diff(repo, "--patch")
+    
+    @pytest.mark.asyncio
+    async def test_file_names_needing_quoting(self, workspace):
+        """Test names that aren't UTF-8, aren't ASCII, or contain quotes."""
+        run_git(workspace, "checkout", "-q", "-b", "names", "main")
+        (workspace / os.fsdecode(b"caf\xe9.txt")).write_text("latin-1 name\n")
+        (workspace / "über notes.txt").write_text("non-ASCII name\n")
+        (workspace / 'say "hi".txt').write_text("quoted name\n")
+        run_git(workspace, "add", "-A")
+        run_git(workspace, "commit", "-q", "-m", "Add awkward names")
+    
+        data = json.loads(await analyze_file_changes())
+    
+        assert "caf�.txt" in data["changed_files"]
+        self.assert_matches_git(workspace, data)
+    
+    @pytest.mark.asyncio
+    async def test_renames_deletions_and_binary_files(self, workspace):
+        """Test a rename into another directory, a deletion, a binary file and a long path."""
+        run_git(workspace, "checkout", "-q", "main")
+        (workspace / "src").mkdir()
+        (workspace / "src" / "util.py").write_text("".join(f"value_{i} = {i}\n" for i in range(20)))
+        (workspace / "obsolete.txt").write_text("no longer needed\n")
+        run_git(workspace, "add", "-A")
+        run_git(workspace, "commit", "-q", "-m", "Add files to change")
+    
+        run_git(workspace, "checkout", "-q", "-b", "changes")
+        (workspace / "lib").mkdir()
+        run_git(workspace, "mv", "src/util.py", "lib/util.py")
+        run_git(workspace, "rm", "-q", "obsolete.txt")
+        (workspace / "logo.png").write_bytes(bytes(range(256)) * 4)
+        long_dir = workspace / "docs" / "a-rather-long-directory-name" / "with-nested-parts"
+        long_dir.mkdir(parents=True)
+        (long_dir / "and-a-long-file-name.md").write_text("# Long\n")
+        run_git(workspace, "add", "-A")
+        run_git(workspace, "commit", "-q", "-m", "Move, delete and add files")
+    
+        data = json.loads(await analyze_file_changes())
+    
+        assert "{src => lib}/util.py" in data["stats"]
+        assert ".../with-nested-parts/and-a-long-file-name.md" in data["stats"]
+        self.assert_matches_git(workspace, data)
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestDiffCache:
+    """Test that analyze_file_changes responses are reused until a commit moves."""
+    
+    @pytest.fixture
+    def diff_calls(self, monkeypatch):
+        """Count how often a diff is actually computed, by either backend."""
+        calls = []
+        compute_diff = server._compute_diff
+        stream_diff = server._stream_diff
+        
+        def counting_compute_diff(*args):
+            calls.append(args)
+            return compute_diff(*args)
+        
+        async def counting_stream_diff(*args):
+            calls.append(args)
+            return await stream_diff(*args)
+        
+        monkeypatch.setattr(server, "_compute_diff", counting_compute_diff)
+        monkeypatch.setattr(server, "_stream_diff", counting_stream_diff)
+        return calls
+    
+    @pytest.mark.asyncio
+    async def test_cache_hit(self, workspace, diff_calls):
+        """Test that a repeated call with unchanged commits doesn't diff again."""
+        first = await analyze_file_changes(max_diff_lines=20)
+        second = await analyze_file_changes(max_diff_lines=20)
+        
+        assert second == first
+        assert len(diff_calls) == 1
+        assert json.loads(first)["changed_files"] == ["README.md", "big.txt"]
+    
+    @pytest.mark.asyncio
+    async def test_cache_miss_when_head_moves(self, workspace, diff_calls):
+        """Test that a new commit on HEAD is picked up instead of the cached response."""
+        await analyze_file_changes(max_diff_lines=20)
+        
+        (workspace / "new.txt").write_text("new\n")
+        run_git(workspace, "add", "-A")
+        run_git(workspace, "commit", "-q", "-m", "Add new file")
+        data = json.loads(await analyze_file_changes(max_diff_lines=20))
+        
+        assert len(diff_calls) == 2
+        assert data["changed_files"] == ["README.md", "big.txt", "new.txt"]
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestRootsCache:
+    """Test that the client's workspace roots are requested once per session."""
+    
+    @pytest.mark.asyncio
+    async def test_roots_requested_once(self, workspace):
+        """Test that a second tool call reuses the cached workspace root."""
+        list_roots = server.mcp.get_context().session.list_roots
+    
+        await analyze_file_changes(include_diff=False)
+        await analyze_file_changes(include_diff=False)
+    
+        assert list_roots.await_count == 1
+    
+    @pytest.mark.asyncio
+    async def test_roots_requested_again_after_failure(self, workspace):
+        """Test that a failed call drops the cached root, in case the client's roots changed."""
+        list_roots = server.mcp.get_context().session.list_roots
+    
+        await analyze_file_changes(include_diff=False)
+        assert "error" in json.loads(await analyze_file_changes(base_branch="nope", include_diff=False))
+        await analyze_file_changes(include_diff=False)
+    
+        assert list_roots.await_count == 2
+
+
+@pytest.mark.skipif(not IMPORTS_SUCCESSFUL, reason="Imports failed")
+class TestResources:
+    """Test the pr://diff and pr://templates resources."""
+    
+    @pytest.mark.asyncio
+    async def test_diff_resource(self, workspace):
+        """Test that diff_as_resource returns a URI that serves the same diff text."""
+        inline = json.loads(await analyze_file_changes(max_diff_lines=20))
+        data = json.loads(await analyze_file_changes(max_diff_lines=20, diff_as_resource=True))
+        
+        assert "diff" not in data
+        assert data["diff_truncated"]
+        contents = await mcp.read_resource(data["diff_resource"])
+        assert contents[0].content == inline["diff"]
+    
+    @pytest.mark.asyncio
+    async def test_evicted_diff_resource_is_republished(self, workspace):
+        """Test that a cached response isn't reused once its diff resource is gone."""
+        data = json.loads(await analyze_file_changes(max_diff_lines=20, diff_as_resource=True))
+        server._DIFF_RESOURCES.clear()
+        
+        with pytest.raises(ValueError, match="no longer available"):
+            await mcp.read_resource(data["diff_resource"])
+        
+        again = json.loads(await analyze_file_changes(max_diff_lines=20, diff_as_resource=True))
+        contents = await mcp.read_resource(again["diff_resource"])
+        assert contents[0].content.startswith("diff --git")
+    
+    @pytest.mark.asyncio
+    async def test_template_resource(self, templates_dir):
+        """Test that the content_resource URI of a listed template serves its content."""
+        (templates_dir / "bug.md").write_text("## Bug Fix\n")
+        
+        data = json.loads(await get_pr_templates(include_content=False))
+        template = data["templates"][0]
+        
+        assert "content" not in template
+        contents = await mcp.read_resource(template["content_resource"])
+        assert contents[0].content == "## Bug Fix\n"
+    
+    @pytest.mark.asyncio
+    async def test_template_resource_errors(self, templates_dir):
+        """Test that only listed templates are served, and unreadable ones report why."""
+        (templates_dir.parent / "secret.md").write_text("secret\n")
+        (templates_dir / "broken.md").write_bytes(b"\xff\xfe")
+        
+        with pytest.raises(ValueError, match="Template not found"):
+            await mcp.read_resource("pr://templates/secret.md")
+        with pytest.raises(ValueError, match="Failed to read file"):
+            await mcp.read_resource("pr://templates/broken.md")
+
+
 if __name__ == "__main__":
     if not IMPORTS_SUCCESSFUL:
         print(f"❌ Cannot run tests - imports failed: {IMPORT_ERROR}")